@@ -0,0 +1,116 @@
+import logging
+import time
+from collections import Counter
+from typing import Optional
+
+import redis.asyncio as redis
+from fastapi import Request, status
+from fastapi.responses import JSONResponse
+from redis import RedisError
+from starlette.routing import Match
+
+from app.settings import CELERY_BROKER_URL, MAX_IN_FLIGHT, ROUTE_CONCURRENCY_LIMIT, ROUTE_CONCURRENCY_LIMITS, \
+    ARRIVAL_QUEUE_THRESHOLD, ARRIVAL_QUEUE_NAME, QUEUE_LENGTH_CACHE_TTL, RETRY_AFTER, REJECTION_LOG_INTERVAL, \
+    REDIS_SOCKET_TIMEOUT, REDIS_CONNECT_TIMEOUT
+from app.state import CircuitBreaker, CircuitOpenError
+
+ARRIVAL_ROUTE = ('POST', '/railstations/{railwaystation_id}/arrival')
+# all paths not matching any route share one limit, so random urls do not add counters
+UNMATCHED_ROUTE = '<unmatched>'
+
+broker_client = redis.Redis.from_url(
+    CELERY_BROKER_URL, socket_timeout=REDIS_SOCKET_TIMEOUT, socket_connect_timeout=REDIS_CONNECT_TIMEOUT
+)
+broker_breaker = CircuitBreaker()
+
+# counters are per process, every web worker sheds its own load
+in_flight = 0
+route_in_flight: Counter = Counter()
+# rejected requests by reason, since they were last logged
+rejections: Counter = Counter()
+_rejections_logged_at = float('-inf')
+_queue_length: tuple[Optional[int], float] = (None, float('-inf'))
+
+
+def route_path(request: Request) -> str:
+    for route in request.app.router.routes:
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            return route.path
+    return UNMATCHED_ROUTE
+
+
+async def get_queue_length() -> Optional[int]:
+    """Length of the celery broker queue, cached for QUEUE_LENGTH_CACHE_TTL seconds. None if unknown."""
+    global _queue_length
+    length, checked_at = _queue_length
+    if time.monotonic() - checked_at < QUEUE_LENGTH_CACHE_TTL:
+        return length
+    try:
+        length = await broker_breaker.call(broker_client.llen, ARRIVAL_QUEUE_NAME)
+    except CircuitOpenError:
+        length = None
+    except RedisError as e:
+        logging.error(f'Could not check length of the queue {ARRIVAL_QUEUE_NAME}. {str(e)}')
+        length = None
+    _queue_length = (length, time.monotonic())
+    return length
+
+
+def reject(reason: str, detail: str) -> JSONResponse:
+    """Rejections are only counted, and logged at most every REJECTION_LOG_INTERVAL, not to add work under overload."""
+    global _rejections_logged_at
+    rejections[reason] += 1
+    if time.monotonic() - _rejections_logged_at >= REJECTION_LOG_INTERVAL:
+        logging.warning(f'Rejected requests since last report: {dict(rejections)}')
+        rejections.clear()
+        _rejections_logged_at = time.monotonic()
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={'detail': detail},
+        headers={'Retry-After': str(RETRY_AFTER)},
+    )
+
+
+async def admit_request(request: Request, call_next):
+    global in_flight
+    route = route_path(request)
+
+    if (request.method, route) == ARRIVAL_ROUTE:
+        queue_length = await get_queue_length()
+        if queue_length is not None and queue_length > ARRIVAL_QUEUE_THRESHOLD:
+            return reject('queue', f'Arrival queue is full ({queue_length} tasks waiting).')
+
+    if in_flight >= MAX_IN_FLIGHT:
+        return reject('in_flight', 'Server is overloaded.')
+    if route_in_flight[route] >= ROUTE_CONCURRENCY_LIMITS.get(route, ROUTE_CONCURRENCY_LIMIT):
+        return reject(route, f'Too many concurrent requests to {route}.')
+
+    in_flight += 1
+    route_in_flight[route] += 1
+    try:
+        response = await call_next(request)
+    except BaseException:
+        release(route)
+        raise
+
+    # streamed responses (like the export) are in flight until their whole body is sent
+    body_iterator = response.body_iterator
+
+    async def release_after_body():
+        try:
+            async for chunk in body_iterator:
+                yield chunk
+        finally:
+            release(route)
+
+    response.body_iterator = release_after_body()
+    return response
+
+
+def release(route: str):
+    global in_flight
+    in_flight -= 1
+    route_in_flight[route] -= 1
+    if route_in_flight[route] <= 0:
+        del route_in_flight[route]
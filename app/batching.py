@@ -0,0 +1,125 @@
+import asyncio
+import concurrent.futures
+import logging
+import threading
+from typing import Optional
+
+from sqlalchemy import Integer, column, update, values
+from sqlalchemy.exc import NoResultFound
+
+from app.db import engine
+from app.models import Locomotive
+from app.settings import ARRIVAL_BATCH_SIZE, ARRIVAL_BATCH_WINDOW
+
+
+async def update_locomotive_stations(arrivals: list[tuple[int, int]]) -> set[int]:
+    """
+    Moves locomotives to stations with one set based UPDATE ... FROM (VALUES ...) statement.
+    Takes (locomotive_id, railwaystation_id) pairs, returns ids of locomotives which were updated.
+    """
+    table = Locomotive.__table__
+    arrived = values(
+        column('locomotive_id', Integer), column('railwaystation_id', Integer), name='arrived'
+    ).data(arrivals)
+    stmt = (
+        update(table).where(table.c.id == arrived.c.locomotive_id)
+        .values(railwaystation_id=arrived.c.railwaystation_id)
+        .returning(table.c.id)
+    )
+    async with engine.begin() as conn:
+        result = await conn.execute(stmt)
+        return set(result.scalars().all())
+
+
+class ArrivalBatcher:
+    """
+    Coalesces arrival completions of all tasks running in the worker process into batched updates.
+    Tasks run their own event loops, so batches are collected and committed on a separate thread with its own loop.
+    A batch is committed when it has max_size completions or window seconds passed since its first completion.
+    """
+
+    def __init__(self, max_size: int = ARRIVAL_BATCH_SIZE, window: float = ARRIVAL_BATCH_WINDOW):
+        self.max_size = max_size
+        self.window = window
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._loop is not None:
+                return
+            loop = asyncio.new_event_loop()
+            started = threading.Event()
+
+            def run():
+                asyncio.set_event_loop(loop)
+                self._queue = asyncio.Queue()
+                loop.create_task(self._collect())
+                loop.call_soon(started.set)
+                loop.run_forever()
+
+            threading.Thread(target=run, name='arrival-batcher', daemon=True).start()
+            started.wait()
+            self._loop = loop
+
+    async def submit(self, station_id: int, locomotive_id: int) -> None:
+        """Waits until the arrival is committed, raises if it could not be."""
+        self._start()
+        future = concurrent.futures.Future()
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, (locomotive_id, station_id, future))
+        await asyncio.wrap_future(future)
+
+    async def _collect(self):
+        while True:
+            batch = [await self._queue.get()]
+            deadline = self._loop.time() + self.window
+            while len(batch) < self.max_size:
+                timeout = deadline - self._loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self._apply(batch)
+            except Exception as e:  # noqa
+                logging.error(f'Could not apply batch of {len(batch)} arrivals', exc_info=e)
+                for _, _, future in batch:
+                    self._resolve(future, e)
+
+    async def _apply(self, batch: list[tuple[int, int, concurrent.futures.Future]]):
+        # waiting task could have been cancelled meanwhile, its arrival is not committed then
+        batch = [item for item in batch if not item[2].done()]
+        if not batch:
+            return
+        try:
+            updated = await update_locomotive_stations([(lid, sid) for lid, sid, _ in batch])
+        except Exception as e:  # noqa
+            if len(batch) > 1:
+                logging.error(f'Batch of {len(batch)} arrivals failed, applying them one by one. {str(e)}')
+                for item in batch:
+                    await self._apply([item])
+            else:
+                self._resolve(batch[0][2], e)
+            return
+
+        for locomotive_id, _, future in batch:
+            if locomotive_id in updated:
+                self._resolve(future)
+            else:
+                self._resolve(future, NoResultFound(f'Locomotive {locomotive_id} not found.'))
+
+    @staticmethod
+    def _resolve(future: concurrent.futures.Future, exception: Optional[Exception] = None):
+        try:
+            if exception is None:
+                future.set_result(None)
+            else:
+                future.set_exception(exception)
+        except concurrent.futures.InvalidStateError:
+            pass  # cancelled by the waiting task
+
+
+arrival_batcher = ArrivalBatcher()
@@ -0,0 +1,96 @@
+import argparse
+import asyncio
+import time
+from uuid import uuid4
+
+from sqlalchemy import update
+
+from app.batching import ArrivalBatcher
+from app.db import init_db, get_session_ctx, engine
+from app.models import RailWayStation, Locomotive, EngineType
+
+
+async def create_data(count: int) -> tuple[int, list[int]]:
+    prefix = f'bench-{uuid4().hex[:8]}'
+    station = RailWayStation(
+        name=f'{prefix} Station', longitude=0, latitude=0, arrival_duration=0, departure_duration=0
+    )
+    locomotives = [
+        Locomotive(name=f'{prefix} Locomotive {i}', number=str(i), engine_type=EngineType.fuel.value)
+        for i in range(count)
+    ]
+    async with get_session_ctx() as session:
+        session.add(station)
+        session.add_all(locomotives)
+        await session.commit()
+    return station.id, [locomotive.id for locomotive in locomotives]
+
+
+async def reset(locomotive_ids: list[int]):
+    table = Locomotive.__table__
+    async with engine.begin() as conn:
+        await conn.execute(update(table).where(table.c.id.in_(locomotive_ids)).values(railwaystation_id=None))
+
+
+async def load_arrivals(station_id: int, locomotive_ids: list[int], concurrency: int):
+    """Loads station and locomotive for every arrival in its own session, as tasks do before waiting for the arrival."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def load(locomotive_id):
+        async with semaphore:
+            async with get_session_ctx() as session:
+                station = await RailWayStation.get(session, _id=station_id)
+                locomotive = await Locomotive.get(session, _id=locomotive_id)
+            return station, locomotive
+
+    return await asyncio.gather(*map(load, locomotive_ids))
+
+
+async def run_unbatched(arrivals: list[tuple[RailWayStation, Locomotive]], concurrency: int):
+    """One session and commit per arrival, as many in parallel as there are concurrent tasks."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def arrive(station, locomotive):
+        async with semaphore:
+            async with get_session_ctx() as session:
+                locomotive.railwaystation = station
+                session.add(locomotive)
+                await session.commit()
+
+    await asyncio.gather(*(arrive(station, locomotive) for station, locomotive in arrivals))
+
+
+async def run_batched(station_id: int, locomotive_ids: list[int], batcher: ArrivalBatcher):
+    await asyncio.gather(*(batcher.submit(station_id, locomotive_id) for locomotive_id in locomotive_ids))
+
+
+async def benchmark(args: argparse.Namespace):
+    await init_db()
+    station_id, locomotive_ids = await create_data(args.arrivals)
+
+    await reset(locomotive_ids)
+    arrivals = await load_arrivals(station_id, locomotive_ids, args.concurrency)  # not measured
+
+    runs = {
+        'unbatched': lambda: run_unbatched(arrivals, args.concurrency),
+        'batched': lambda: run_batched(station_id, locomotive_ids, ArrivalBatcher(args.batch_size, args.window)),
+    }
+    for name, run in runs.items():
+        await reset(locomotive_ids)
+        started_at = time.perf_counter()
+        await run()
+        elapsed = time.perf_counter() - started_at
+        print(f'{name:>10}: {args.arrivals} arrivals in {elapsed:.3f}s, {args.arrivals / elapsed:.1f} commits/s')
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Compares arrival commit throughput with and without batching.')
+    parser.add_argument('--arrivals', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=50, help='parallel transactions without batching')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--window', type=float, default=0.05)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    asyncio.run(benchmark(parse_args()))
@@ -0,0 +1,85 @@
+import argparse
+import asyncio
+import json
+import time
+
+import redis.asyncio as redis
+
+from app.board import StationBoardHub, CHANNEL_PREFIX, RESYNC
+from app.settings import REDIS_URL
+
+
+async def consume(queue: asyncio.Queue, latencies: list[float], resyncs: list[int], expected: int, delay: float):
+    received = 0
+    while received < expected:
+        message = await queue.get()
+        if message is RESYNC:
+            resyncs.append(1)
+            continue
+        latencies.append(time.time() - json.loads(message)['sent_at'])
+        received += 1
+        if delay:
+            await asyncio.sleep(delay)
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))] if values else float('nan')
+
+
+async def benchmark(args: argparse.Namespace):
+    """
+    Fans station events out to in-process subscribers, the same way websockets of one web process are served,
+    but without the websocket transport itself.
+    """
+    client = redis.Redis.from_url(REDIS_URL)
+    hub = StationBoardHub(client, queue_size=args.queue_size)
+
+    latencies, slow_latencies, resyncs = [], [], []
+    consumers = []
+    for i in range(args.subscribers):
+        station_id = i % args.stations
+        queue = hub.subscribe(station_id)
+        if i < args.slow_subscribers:
+            consumer = consume(queue, slow_latencies, resyncs, float('inf'), args.slow_delay)
+        else:
+            expected = args.events // args.stations + (station_id < args.events % args.stations)
+            consumer = consume(queue, latencies, resyncs, expected, 0)
+        consumers.append(asyncio.create_task(consumer))
+    await asyncio.sleep(1)  # let the subscription start
+    resyncs.clear()
+
+    started_at = time.perf_counter()
+    for i in range(args.events):
+        station_id = i % args.stations
+        await client.publish(f'{CHANNEL_PREFIX}{station_id}', json.dumps({'event': 'arrival', 'sent_at': time.time()}))
+    await asyncio.wait_for(asyncio.gather(*consumers[args.slow_subscribers:]), timeout=args.timeout)
+    elapsed = time.perf_counter() - started_at
+
+    for consumer in consumers[:args.slow_subscribers]:
+        consumer.cancel()
+    await hub.close()
+
+    print(f'Subscribers: {args.subscribers} on {args.stations} stations ({args.slow_subscribers} slow)')
+    print(f'Delivered:   {len(latencies)} messages in {elapsed:.3f}s, {len(latencies) / elapsed:.0f} messages/s')
+    print(f'Resyncs:     {len(resyncs)}')
+    print(
+        f'Latency [ms]: p50={percentile(latencies, 50) * 1000:.2f} p95={percentile(latencies, 95) * 1000:.2f} '
+        f'p99={percentile(latencies, 99) * 1000:.2f} max={max(latencies, default=float("nan")) * 1000:.2f}'
+    )
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Measures station board fan-out to many concurrent subscribers.')
+    parser.add_argument('--subscribers', type=int, default=10_000)
+    parser.add_argument('--stations', type=int, default=100)
+    parser.add_argument('--events', type=int, default=1000, help='spread evenly over stations')
+    parser.add_argument('--queue-size', type=int, default=100)
+    parser.add_argument('--slow-subscribers', type=int, default=100)
+    parser.add_argument('--slow-delay', type=float, default=1, help='seconds slow subscriber spends on a message')
+    parser.add_argument('--timeout', type=float, default=120)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    asyncio.run(benchmark(parse_args()))
@@ -0,0 +1,121 @@
+import asyncio
+import json
+import logging
+from collections import defaultdict
+from typing import Optional, Callable, Awaitable
+
+import redis.asyncio as redis
+from redis import RedisError
+
+from app.settings import BOARD_QUEUE_SIZE, REDIS_URL, REDIS_CONNECT_TIMEOUT, BOARD_HEALTH_CHECK_INTERVAL
+from app.state import error_wrapper, get_redis_client, breaker
+
+CHANNEL_PREFIX = 'station:'
+
+# put into subscriber queue when it is new or missed events, so it has to fetch the whole station again
+RESYNC = None
+
+
+@error_wrapper
+async def publish_station_event(station_id: int, event: str, **data):
+    message = json.dumps({'event': event, 'railwaystation_id': station_id, **data})
+    return await breaker.call(get_redis_client().publish, f'{CHANNEL_PREFIX}{station_id}', message)
+
+
+class StationBoardHub:
+    """
+    Fans out station events within the web process. One redis subscription serves all websockets,
+    each of them gets a bounded queue. When a slow consumer's queue is full, its pending events are dropped
+    and replaced with RESYNC. Subscribers resyncing together share one snapshot of the station.
+    """
+
+    def __init__(self, client: redis.Redis, queue_size: int = BOARD_QUEUE_SIZE):
+        self.client = client
+        self.queue_size = queue_size
+        self.subscribers: dict[int, set[asyncio.Queue]] = defaultdict(set)
+        self._listener: Optional[asyncio.Task] = None
+        self._snapshots: dict[int, asyncio.Task] = {}
+        # stations which got RESYNC after their snapshot in progress started loading
+        self._stale: set[int] = set()
+
+    def subscribe(self, station_id: int) -> asyncio.Queue:
+        if self._listener is None or self._listener.done():
+            self._listener = asyncio.create_task(self._listen())
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self.subscribers[station_id].add(queue)
+        self._put(station_id, queue, RESYNC)  # starts with a snapshot
+        return queue
+
+    def unsubscribe(self, station_id: int, queue: asyncio.Queue):
+        self.subscribers[station_id].discard(queue)
+        if not self.subscribers[station_id]:
+            del self.subscribers[station_id]
+
+    def dispatch(self, station_id: int, message: Optional[str]):
+        for queue in self.subscribers.get(station_id, ()):
+            self._put(station_id, queue, message)
+
+    def resync_all(self):
+        for station_id, queues in self.subscribers.items():
+            for queue in queues:
+                self._put(station_id, queue, RESYNC)
+
+    def _put(self, station_id: int, queue: asyncio.Queue, message: Optional[str]):
+        if queue.full():
+            while not queue.empty():
+                queue.get_nowait()
+            message = RESYNC
+        if message is RESYNC:
+            self._stale.add(station_id)
+        queue.put_nowait(message)
+
+    async def snapshot(self, station_id: int, load: Callable[[int], Awaitable[str]]) -> str:
+        """
+        Snapshot of the station for a subscriber which got RESYNC. A load in progress is shared, unless RESYNC
+        was put after it started, as it could miss the dropped events then.
+        """
+        task = self._snapshots.get(station_id)
+        if task is None or station_id in self._stale:
+            self._stale.discard(station_id)
+            task = self._snapshots[station_id] = asyncio.create_task(load(station_id))
+            task.add_done_callback(lambda _: self._forget_snapshot(station_id, task))
+        # cancelling one subscriber must not cancel the load for the others
+        return await asyncio.shield(task)
+
+    def _forget_snapshot(self, station_id: int, task: asyncio.Task):
+        if self._snapshots.get(station_id) is task:
+            del self._snapshots[station_id]
+
+    async def _listen(self):
+        reconnecting = False
+        while True:
+            try:
+                async with self.client.pubsub() as pubsub:
+                    await pubsub.psubscribe(f'{CHANNEL_PREFIX}*')
+                    async for message in pubsub.listen():
+                        if message['type'] == 'psubscribe':
+                            if reconnecting:
+                                self.resync_all()  # events could be missed while reconnecting
+                            reconnecting = True
+                        elif message['type'] == 'pmessage':
+                            station_id = int(message['channel'].decode().removeprefix(CHANNEL_PREFIX))
+                            self.dispatch(station_id, message['data'].decode())
+            except RedisError as e:
+                logging.error(f'Station board subscription failed, reconnecting. {str(e)}')
+                await asyncio.sleep(1)
+
+    async def close(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+        await self.client.aclose()
+
+
+# subscription blocks on reads, so it can not use socket_timeout of the shared client,
+# dead connections are noticed by health check pings instead
+board_hub = StationBoardHub(redis.Redis.from_url(
+    REDIS_URL, socket_connect_timeout=REDIS_CONNECT_TIMEOUT, health_check_interval=BOARD_HEALTH_CHECK_INTERVAL
+))
@@ -3,6 +3,7 @@ import contextlib
 import logging
 from asyncio import current_task
 
+from sqlalchemy import text
 from sqlalchemy.exc import SQLAlchemyError, InvalidRequestError, DatabaseError
 from sqlmodel.ext.asyncio.session import AsyncSession
 from sqlalchemy.ext.asyncio import create_async_engine
@@ -11,7 +12,12 @@ from sqlalchemy.pool import NullPool
 
 from . import settings
 
-engine = create_async_engine(settings.DATABASE_URL, echo=True, future=True, poolclass=NullPool)
+if settings.DB_POOL_SIZE:
+    pool_options = dict(pool_size=settings.DB_POOL_SIZE, max_overflow=settings.DB_MAX_OVERFLOW, pool_pre_ping=True)
+else:
+    pool_options = dict(poolclass=NullPool)
+
+engine = create_async_engine(settings.DATABASE_URL, echo=True, future=True, **pool_options)
 
 
 async def init_db(delete=False):
@@ -28,6 +34,15 @@ async def init_db(delete=False):
         logging.info("Model migration finished")
 
 
+async def prewarm_db_pool():
+    async def connect():
+        async with engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+
+    await asyncio.gather(*(connect() for _ in range(settings.DB_POOL_SIZE)))
+    logging.info(f"Database pool warmed up with {settings.DB_POOL_SIZE} connections")
+
+
 class AsyncMultiSession(AsyncSession):
     async def refresh_all(self, *instances):
         await self.reset()
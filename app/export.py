@@ -0,0 +1,67 @@
+import csv
+import io
+import json
+from typing import AsyncIterator, Optional
+
+from sqlalchemy import select, Row
+
+from app.db import engine
+from app.models import RailWayStation, Locomotive
+from app.settings import EXPORT_CHUNK_SIZE
+
+STATION_COLUMNS = ['id', 'name', 'longitude', 'latitude', 'arrival_duration', 'departure_duration']
+LOCOMOTIVE_COLUMNS = ['id', 'name', 'number', 'engine_type']
+
+
+def export_statement():
+    station, locomotive = RailWayStation.__table__, Locomotive.__table__
+    return (
+        select(
+            *[station.c[name] for name in STATION_COLUMNS],
+            *[locomotive.c[name].label(f'locomotive_{name}') for name in LOCOMOTIVE_COLUMNS],
+        )
+        .select_from(station.outerjoin(locomotive))
+        .order_by(station.c.id, locomotive.c.id)
+        .execution_options(yield_per=EXPORT_CHUNK_SIZE)
+    )
+
+
+async def stream_rows() -> AsyncIterator[list[Row]]:
+    """Yields chunks of EXPORT_CHUNK_SIZE rows fetched from a server side cursor."""
+    async with engine.connect() as conn:
+        result = await conn.stream(export_statement())
+        async for rows in result.partitions():
+            yield rows
+
+
+async def export_ndjson() -> AsyncIterator[str]:
+    """One json line per station, with its locomotives."""
+    station: Optional[dict] = None
+    async for rows in stream_rows():
+        lines = []
+        for row in rows:
+            if station is None or station['id'] != row.id:
+                if station is not None:
+                    lines.append(json.dumps(station) + '\n')
+                station = {name: getattr(row, name) for name in STATION_COLUMNS} | {'locomotives': []}
+            if row.locomotive_id is not None:
+                station['locomotives'].append(
+                    {name: getattr(row, f'locomotive_{name}') for name in LOCOMOTIVE_COLUMNS}
+                )
+        if lines:
+            yield ''.join(lines)
+    if station is not None:
+        yield json.dumps(station) + '\n'
+
+
+async def export_csv() -> AsyncIterator[str]:
+    """One row per locomotive, ordered by station. Stations without locomotives have empty locomotive columns."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([f'station_{name}' for name in STATION_COLUMNS] + [f'locomotive_{name}' for name in LOCOMOTIVE_COLUMNS])
+    yield buffer.getvalue()
+    async for rows in stream_rows():
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(rows)
+        yield buffer.getvalue()
@@ -0,0 +1,13 @@
+# gunicorn -c app/gunicorn.conf.py app.main:app
+import multiprocessing
+import os
+from uuid import uuid4
+
+bind = os.environ.get("BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "uvicorn.workers.UvicornWorker"
+
+
+def on_starting(server):
+    # workers are forked after this, so they all share the id and only one of them initializes the application
+    os.environ.setdefault("APP_INIT_ID", uuid4().hex)
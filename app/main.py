@@ -1,5 +1,7 @@
 import asyncio
+import json
 import logging.config
+import os
 from uuid import uuid4
 
 import celery.result
@@ -13,21 +15,32 @@ import logging.config
 from typing import Optional
 
 import sqlalchemy.exc
-from fastapi import FastAPI, Depends, HTTPException, Request, status
+from sqlalchemy import func
+from fastapi import FastAPI, Depends, HTTPException, Request, Response, status, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, StreamingResponse
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import selectinload
 from sqlmodel import select
 
-from .db import init_db, get_session
+from .admission import admit_request, broker_client
+from .board import board_hub, RESYNC
+from .db import init_db, get_session, get_session_ctx, prewarm_db_pool
 from .exceptions import raise_integrity_error
+from .export import export_ndjson, export_csv
 from .models import RailWayStation, RailWayStationModel, Locomotive, \
-    RailWayStationResponse, StationRequest, TaskStatusResponse, StationResponse
+    RailWayStationResponse, StationRequest, TaskStatusResponse, StationResponse, ExportFormat, EngineType, \
+    RailWayStationOccupancyResponse, ReadinessResponse
+from .profiling import profile_request
 from .settings import *  # noqa
-from .state import redis_client, set_app_busy, init_app_state
+from .state import close_redis_client, set_app_busy, init_app_state, change_arrivals_in_flight, get_arrivals_in_flight, \
+    init_once, prewarm_redis_pool
 
 app = FastAPI()
 
+readiness = {'initialized': False, 'db_pool': False, 'redis_pool': False}
+init_retry: Optional[asyncio.Task] = None
+
 
 @app.middleware("http")
 async def set_app_state(request: Request, call_next):
@@ -36,17 +49,73 @@ async def set_app_state(request: Request, call_next):
     return response
 
 
+@app.middleware("http")
+async def profile(request: Request, call_next):
+    return await profile_request(request, call_next)
+
+
+@app.middleware("http")
+async def admission_control(request: Request, call_next):
+    return await admit_request(request, call_next)
+
+
+@app.middleware("http")
+async def require_ready(request: Request, call_next):
+    # initialization recreates the tables, so no requests are served before it is done
+    if not all(readiness.values()) and request.url.path != '/ready':
+        return JSONResponse(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            content={'detail': 'Server is not ready.'},
+            headers={'Retry-After': str(INIT_RETRY_INTERVAL)},
+        )
+    return await call_next(request)
+
+
+async def init_app():
+    await init_db(True)
+    await init_app_state()
+
+
+async def prepare_worker() -> bool:
+    """Initializes the application and warms up the pools which are not done yet. Returns whether worker is ready."""
+    steps = {
+        'initialized': lambda: init_once(APP_INIT_ID, init_app),
+        'db_pool': prewarm_db_pool,
+        'redis_pool': prewarm_redis_pool,
+    }
+    for step, async_func in steps.items():
+        if readiness[step]:
+            continue
+        try:
+            readiness[step] = await async_func() is not False  # init_once returns False when not initialized
+        except Exception as e:  # noqa
+            logging.error(f'Worker is not ready, {step} failed. {str(e)}')
+    return all(readiness.values())
+
+
+async def retry_prepare_worker():
+    while not await prepare_worker():
+        await asyncio.sleep(INIT_RETRY_INTERVAL)
+    logging.info('Worker is ready')
+
+
 @app.on_event("startup")
 async def on_startup():
+    global init_retry
     logging.info("Initializing")
-    await init_db(True)
-    await init_app_state()
+    if not await prepare_worker():
+        logging.error(f'Worker starts not ready, it is prepared again every {INIT_RETRY_INTERVAL}s')
+        init_retry = asyncio.create_task(retry_prepare_worker())
 
 
 @app.on_event("shutdown")
 async def on_shutdown():
     logging.info("Shutting down...")
-    await redis_client.aclose()
+    if init_retry is not None:
+        init_retry.cancel()
+    await board_hub.close()
+    await close_redis_client()
+    await broker_client.aclose()
 
 
 @app.post("/railstations", response_model=RailWayStationModel, status_code=201)
@@ -86,8 +155,48 @@ async def list_railstations(
     ]
 
 
+@app.get("/railstations/export", status_code=200)
+async def export_railstations(
+        format: ExportFormat = ExportFormat.ndjson,
+) -> StreamingResponse:
+    if format == ExportFormat.csv:
+        return StreamingResponse(
+            export_csv(), media_type='text/csv',
+            headers={'Content-Disposition': 'attachment; filename="railstations.csv"'},
+        )
+    return StreamingResponse(export_ndjson(), media_type='application/x-ndjson')
+
+
+@app.get("/railstations/occupancy", response_model=list[RailWayStationOccupancyResponse], status_code=200)
+async def railstations_occupancy(
+        session: AsyncSession = Depends(get_session),
+) -> list[RailWayStationOccupancyResponse]:
+
+    stmt = (
+        select(RailWayStation.id, RailWayStation.name, Locomotive.engine_type, func.count(Locomotive.id))
+        .join(Locomotive, isouter=True).group_by(RailWayStation.id, Locomotive.engine_type)
+        .order_by(RailWayStation.name)
+    )
+    rows, arrivals_in_flight = await asyncio.gather(session.exec(stmt), get_arrivals_in_flight())
+
+    occupancy = {}
+    for station_id, name, engine_type, count in rows:
+        station = occupancy.setdefault(station_id, RailWayStationOccupancyResponse(
+            railwaystation_id=station_id, name=name,
+            locomotives={_type.value: 0 for _type in EngineType},
+            total=0,
+            # unknown (null) while redis is unavailable
+            arrivals_in_flight=None if arrivals_in_flight is None else arrivals_in_flight.get(station_id, 0),
+        ))
+        if engine_type is not None:
+            station.locomotives[engine_type] = count
+            station.total += count
+
+    return list(occupancy.values())
+
+
 @app.get("/railstations/{_id}", response_model=RailWayStationResponse, status_code=200)
-async def create_railstation(
+async def get_railstation(
         _id: int,
         session: AsyncSession = Depends(get_session),
 ) -> RailWayStationResponse:
@@ -104,6 +213,47 @@ async def create_railstation(
         raise HTTPException(status_code=404, detail=f'Station with id {_id} not found.')
 
 
+async def load_board_snapshot(_id: int) -> str:
+    async with get_session_ctx() as session:
+        railwaystation = await get_railstation(_id, session)
+    return json.dumps({'event': 'snapshot', 'railwaystation': railwaystation.model_dump(mode='json')})
+
+
+@app.websocket("/railstations/{_id}/board")
+async def railstation_board(websocket: WebSocket, _id: int):
+    if not all(readiness.values()):
+        await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER, reason='Server is not ready.')
+        return
+    await websocket.accept()
+    queue = board_hub.subscribe(_id)
+    # the socket is read meanwhile, so disconnect is noticed even when there are no events for the station
+    receive = asyncio.create_task(websocket.receive())
+    get = None
+    try:
+        while True:
+            get = asyncio.create_task(queue.get())
+            done, _ = await asyncio.wait({get, receive}, return_when=asyncio.FIRST_COMPLETED)
+            if get in done:
+                message = get.result()
+                if message is RESYNC:
+                    message = await board_hub.snapshot(_id, load_board_snapshot)
+                await websocket.send_text(message)
+            if receive in done:
+                if receive.result()['type'] == 'websocket.disconnect':
+                    break
+                receive = asyncio.create_task(websocket.receive())  # messages from clients are ignored
+            get.cancel()
+    except HTTPException as e:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason=e.detail)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        receive.cancel()
+        if get is not None:
+            get.cancel()
+        board_hub.unsubscribe(_id, queue)
+
+
 @app.post(
     "/railstations/{railwaystation_id}/arrival",
     response_model=StationResponse, status_code=202
@@ -123,10 +273,17 @@ async def perform_railstation_arrival(
         )
 
     task_id = uuid4()
-    result: AsyncResult = tasks.perform_arrival.apply_async(
-        args=[railwaystation_id, request.locomotive_id, str(request.notify_url)],
-        task_id=str(task_id),
-    )
+    # task decrements the count only if it was incremented, so a redis failure here does not make it drift
+    in_flight_counted = await change_arrivals_in_flight(railwaystation_id, 1) is not None
+    try:
+        result: AsyncResult = tasks.perform_arrival.apply_async(
+            args=[railwaystation_id, request.locomotive_id, str(request.notify_url), in_flight_counted],
+            task_id=str(task_id),
+        )
+    except Exception:
+        if in_flight_counted:
+            await change_arrivals_in_flight(railwaystation_id, -1)
+        raise
 
     return StationResponse(
         railwaystation_id=railwaystation_id,
@@ -147,3 +304,11 @@ async def task_status(
 ) -> TaskStatusResponse:
     result = celery.result.AsyncResult(str(task_id))
     return TaskStatusResponse(task_id=task_id, status=result.status)
+
+
+@app.get("/ready", response_model=ReadinessResponse, status_code=200)
+async def ready(response: Response) -> ReadinessResponse:
+    readiness_response = ReadinessResponse(ready=all(readiness.values()), pid=os.getpid(), **readiness)
+    if not readiness_response.ready:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return readiness_response
@@ -116,5 +116,26 @@ class StationResponse(BaseModel):
     status: ArrivalDepartureStatus
 
 
+class RailWayStationOccupancyResponse(BaseModel):
+    railwaystation_id: int
+    name: str
+    locomotives: dict[str, int]
+    total: int
+    arrivals_in_flight: Optional[int]
+
+
+class ExportFormat(enum.Enum):
+    ndjson = 'ndjson'
+    csv = 'csv'
+
+
+class ReadinessResponse(BaseModel):
+    ready: bool
+    initialized: bool
+    db_pool: bool
+    redis_pool: bool
+    pid: int
+
+
 class AppStatusResponse(BaseModel):
     request_counter: int
@@ -0,0 +1,182 @@
+import cProfile
+import hashlib
+import hmac
+import json
+import logging
+import os
+import random
+import re
+import time
+from collections import Counter
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Optional
+from uuid import uuid4
+
+from fastapi import Request
+from sqlalchemy import event
+
+from app.db import engine
+from app.settings import PROFILE_SECRET, PROFILE_SAMPLE_RATE, PROFILE_DIR, PROFILE_N_PLUS_ONE_THRESHOLD, \
+    PROFILE_SIGNATURE_TTL
+
+PROFILE_HEADER = 'X-Profile-Signature'
+
+_sql_stats: ContextVar[Optional["SqlStats"]] = ContextVar('sql_stats', default=None)
+_profiler_active = False
+
+
+@dataclass
+class SqlStats:
+    count: int = 0
+    duration: float = 0
+    shapes: Counter = field(default_factory=Counter)
+
+    def n_plus_one_candidates(self) -> dict[str, int]:
+        return {
+            shape: count for shape, count in self.shapes.items()
+            if count >= PROFILE_N_PLUS_ONE_THRESHOLD
+        }
+
+
+def statement_shape(statement: str) -> str:
+    """Normalizes sql statement, so the same query with different parameters has the same shape."""
+    shape = re.sub(r'\$\d+|%\(\w+\)s|\?', '?', statement)
+    shape = re.sub(r'\b\d+\b', '?', shape)
+    shape = re.sub(r'\(\s*\?(::\w+)?(\s*,\s*\?(::\w+)?)*\s*\)', '(?)', shape)  # IN lists of any length
+    return ' '.join(shape.split())
+
+
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _sql_stats.get() is not None:
+        conn.info.setdefault('profile_query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(engine.sync_engine, "after_cursor_execute")
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _sql_stats.get()
+    if stats is None or not conn.info.get('profile_query_start'):
+        return
+    stats.count += 1
+    stats.duration += time.perf_counter() - conn.info['profile_query_start'].pop()
+    stats.shapes[statement_shape(statement)] += 1
+
+
+def sign_profile_request(method: str, path: str, timestamp: Optional[int] = None) -> str:
+    """Returns X-Profile-Signature header value, '<timestamp>:<hmac>'. It expires after PROFILE_SIGNATURE_TTL."""
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    message = f'{method.upper()} {path} {timestamp}'.encode()
+    return f'{timestamp}:{hmac.new(PROFILE_SECRET.encode(), message, hashlib.sha256).hexdigest()}'
+
+
+def is_signature_valid(request: Request, signature: str) -> bool:
+    timestamp, _, _ = signature.partition(':')
+    try:
+        timestamp = int(timestamp)
+    except ValueError:
+        return False
+    if abs(time.time() - timestamp) > PROFILE_SIGNATURE_TTL:
+        return False
+    return hmac.compare_digest(signature, sign_profile_request(request.method, request.url.path, timestamp))
+
+
+def is_signed(request: Request) -> bool:
+    signature = request.headers.get(PROFILE_HEADER)
+    if signature and PROFILE_SECRET:
+        if is_signature_valid(request, signature):
+            return True
+        logging.warning(f'Invalid or expired profile signature for {request.method} {request.url.path}')
+    return False
+
+
+def start_profiler() -> Optional[cProfile.Profile]:
+    """
+    cProfile hooks the whole thread, so it measures everything the event loop runs meanwhile,
+    not only the profiled handler. Only one profiler may be active at once, others get None.
+    """
+    global _profiler_active
+    if _profiler_active:
+        return None
+    _profiler_active = True
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def stop_profiler(profiler: Optional[cProfile.Profile]):
+    global _profiler_active
+    if profiler is not None:
+        profiler.disable()
+        _profiler_active = False
+
+
+def save_profile(profile_id: str, request: Request, stats: SqlStats, profiler: Optional[cProfile.Profile]):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    if profiler is not None:
+        profiler.dump_stats(os.path.join(PROFILE_DIR, f'{profile_id}.prof'))
+    with open(os.path.join(PROFILE_DIR, f'{profile_id}.json'), 'w') as f:
+        json.dump({
+            'method': request.method,
+            'path': request.url.path,
+            'sql_count': stats.count,
+            'sql_duration': stats.duration,
+            'n_plus_one_candidates': stats.n_plus_one_candidates(),
+            'statements': dict(stats.shapes.most_common()),
+        }, f, indent=2)
+
+
+async def profile_request(request: Request, call_next):
+    """
+    Signed requests get X-Profile-* response headers, sampled ones are saved to PROFILE_DIR.
+    Headers are sent before the response body, so for streamed responses (like the export) they cover
+    only the work done until streaming started. Saved profiles and N+1 warnings cover the whole body.
+    """
+    signed = is_signed(request)
+    sampled = not signed and bool(PROFILE_DIR) and random.random() < PROFILE_SAMPLE_RATE
+    if not signed and not sampled:
+        return await call_next(request)
+
+    profile_id = uuid4().hex
+    stats = SqlStats()
+    token = _sql_stats.set(stats)
+    profiler = start_profiler() if sampled else None
+    try:
+        response = await call_next(request)
+    except BaseException:
+        stop_profiler(profiler)
+        raise
+    finally:
+        _sql_stats.reset(token)  # the handler runs in its own task, with its own copy of the context
+
+    if signed:
+        response.headers['X-Profile-Id'] = profile_id
+        response.headers['X-Profile-SQL-Count'] = str(stats.count)
+        response.headers['X-Profile-SQL-Duration-Ms'] = f'{stats.duration * 1000:.3f}'
+        response.headers['X-Profile-N-Plus-One'] = str(len(stats.n_plus_one_candidates()))
+
+    body_iterator = response.body_iterator
+
+    async def finish_after_body():
+        try:
+            async for chunk in body_iterator:
+                yield chunk
+        finally:
+            stop_profiler(profiler)
+            finish_profile(profile_id, request, stats, profiler, save=sampled)
+
+    response.body_iterator = finish_after_body()
+    return response
+
+
+def finish_profile(
+        profile_id: str, request: Request, stats: SqlStats, profiler: Optional[cProfile.Profile], save: bool,
+):
+    for shape, count in stats.n_plus_one_candidates().items():
+        logging.warning(f'Possible N+1 query in {request.method} {request.url.path}, executed {count} times: {shape}')
+
+    if save:
+        try:
+            save_profile(profile_id, request, stats, profiler)
+        except OSError as e:
+            logging.error(f'Could not save profile {profile_id} to {PROFILE_DIR}. {str(e)}')
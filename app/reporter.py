@@ -4,7 +4,7 @@ import logging
 import httpx
 
 from app.settings import STATE_URL, STATE_INTERVAL
-from app.state import get_app_state, redis_client
+from app.state import get_app_state, close_redis_client
 
 
 async def send_state(client: httpx.AsyncClient):
@@ -36,7 +36,7 @@ async def report_state():
         except KeyboardInterrupt:
             pass
 
-    await redis_client.aclose()
+    await close_redis_client()
 
     logging.info('State reporting shutdown...')
 
@@ -1,3 +1,4 @@
+import json
 import logging.config
 import os
 
@@ -37,3 +38,51 @@ STATE_INTERVAL = env("STATE_INTERVAL")
 CELERY_BROKER_URL = env("CELERY_BROKER_URL")
 CELERY_RESULT_BACKEND = env("CELERY_RESULT_BACKEND")
 REDIS_URL = env("REDIS_URL")
+
+# per-request profiling, see app/profiling.py
+PROFILE_SECRET = env("PROFILE_SECRET")
+PROFILE_SAMPLE_RATE = float(env("PROFILE_SAMPLE_RATE", 0))
+PROFILE_DIR = env("PROFILE_DIR")
+PROFILE_N_PLUS_ONE_THRESHOLD = int(env("PROFILE_N_PLUS_ONE_THRESHOLD", 3))
+PROFILE_SIGNATURE_TTL = float(env("PROFILE_SIGNATURE_TTL", 60))
+
+# admission control, see app/admission.py
+MAX_IN_FLIGHT = int(env("MAX_IN_FLIGHT", 200))
+ROUTE_CONCURRENCY_LIMIT = int(env("ROUTE_CONCURRENCY_LIMIT", 100))
+# json object of route path: limit, export streams hold a db connection for their whole length
+ROUTE_CONCURRENCY_LIMITS = {
+    "/railstations/export": 4,
+    **json.loads(env("ROUTE_CONCURRENCY_LIMITS", "{}")),
+}
+ARRIVAL_QUEUE_THRESHOLD = int(env("ARRIVAL_QUEUE_THRESHOLD", 1000))
+ARRIVAL_QUEUE_NAME = env("ARRIVAL_QUEUE_NAME", "celery")
+QUEUE_LENGTH_CACHE_TTL = float(env("QUEUE_LENGTH_CACHE_TTL", 1))
+RETRY_AFTER = int(env("RETRY_AFTER", 5))
+REJECTION_LOG_INTERVAL = float(env("REJECTION_LOG_INTERVAL", 10))
+
+# group commit of arrival completions, see app/batching.py
+ARRIVAL_BATCH_SIZE = int(env("ARRIVAL_BATCH_SIZE", 100))
+ARRIVAL_BATCH_WINDOW = float(env("ARRIVAL_BATCH_WINDOW", 0.05))
+
+# rows fetched from the server side cursor at once by the export, see app/export.py
+EXPORT_CHUNK_SIZE = int(env("EXPORT_CHUNK_SIZE", 1000))
+
+# live station board, see app/board.py
+BOARD_QUEUE_SIZE = int(env("BOARD_QUEUE_SIZE", 100))
+BOARD_HEALTH_CHECK_INTERVAL = int(env("BOARD_HEALTH_CHECK_INTERVAL", 30))
+
+# redis timeouts and circuit breaker, see app/state.py
+REDIS_SOCKET_TIMEOUT = float(env("REDIS_SOCKET_TIMEOUT", 1))
+REDIS_CONNECT_TIMEOUT = float(env("REDIS_CONNECT_TIMEOUT", 1))
+REDIS_FAILURE_THRESHOLD = int(env("REDIS_FAILURE_THRESHOLD", 3))
+REDIS_RESET_TIMEOUT = float(env("REDIS_RESET_TIMEOUT", 5))
+
+# multi worker serving, see app/gunicorn.conf.py
+# workers started together share APP_INIT_ID, so only one of them initializes the database and the state
+APP_INIT_ID = env("APP_INIT_ID")
+INIT_LOCK_TIMEOUT = float(env("INIT_LOCK_TIMEOUT", 60))
+INIT_RETRY_INTERVAL = float(env("INIT_RETRY_INTERVAL", 5))
+# 0 means no connection pool, which tasks need, as they run each in its own event loop
+DB_POOL_SIZE = int(env("DB_POOL_SIZE", 0))
+DB_MAX_OVERFLOW = int(env("DB_MAX_OVERFLOW", 0))
+REDIS_PREWARM_CONNECTIONS = int(env("REDIS_PREWARM_CONNECTIONS", 10))
@@ -0,0 +1,207 @@
+import argparse
+import asyncio
+import logging
+import random
+import time
+from dataclasses import dataclass
+from typing import Optional
+from uuid import uuid4
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, status
+
+from app.db import get_session_ctx
+from app.models import Locomotive, EngineType, ArrivalDepartureStatus
+
+
+@dataclass
+class Arrival:
+    locomotive_id: int
+    railwaystation_id: int
+    submitted_at: float
+    status_code: Optional[int] = None
+    estimated_duration: Optional[float] = None
+    notified_at: Optional[float] = None
+    status: Optional[str] = None
+
+    @property
+    def latency(self) -> float:
+        return self.notified_at - self.submitted_at
+
+    @property
+    def lag(self) -> float:
+        return self.latency - self.estimated_duration
+
+
+class NotifySink:
+    """Local notify_url endpoint, records when notification for each locomotive arrived."""
+
+    def __init__(self, arrivals: dict[int, Arrival]):
+        self.arrivals = arrivals
+        self.expected = 0
+        self.received = 0
+        self.done = asyncio.Event()
+        self.app = FastAPI()
+        self.app.get('/notify')(self.notify)
+
+    async def notify(self, railwaystation_id: int, locomotive_id: int, status: str):
+        arrival = self.arrivals.get(locomotive_id)
+        if arrival is not None and arrival.notified_at is None:
+            arrival.notified_at = time.monotonic()
+            arrival.status = status
+            self.received += 1
+            if self.received >= self.expected:
+                self.done.set()
+        return {}
+
+
+def interarrival_times(model: str, rate: float):
+    while True:
+        if model == 'poisson':
+            yield random.expovariate(rate)
+        else:
+            yield 1 / rate
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+async def create_stations(client: httpx.AsyncClient, count: int, arrival_duration: float, prefix: str) -> list[int]:
+    async def create(i):
+        response = await client.post('/railstations', json={
+            'name': f'{prefix} Station {i}',
+            'longitude': random.uniform(14, 24),
+            'latitude': random.uniform(49, 55),
+            'arrival_duration': arrival_duration,
+            'departure_duration': arrival_duration,
+        })
+        response.raise_for_status()
+        return response.json()['id']
+
+    return list(await asyncio.gather(*map(create, range(count))))
+
+
+async def create_locomotives(count: int, prefix: str) -> list[int]:
+    # there is no api for locomotives, they go straight to the database
+    locomotives = [
+        Locomotive(
+            name=f'{prefix} Locomotive {i}',
+            number=f'{prefix}-{i}',
+            engine_type=random.choice(list(EngineType)).value,
+        )
+        for i in range(count)
+    ]
+    async with get_session_ctx() as session:
+        session.add_all(locomotives)
+        await session.commit()
+    return [locomotive.id for locomotive in locomotives]
+
+
+async def drive_arrivals(
+        client: httpx.AsyncClient, arrivals: dict[int, Arrival], station_ids: list[int], locomotive_ids: list[int],
+        model: str, rate: float, notify_url: str,
+):
+    async def arrive(arrival: Arrival):
+        try:
+            response = await client.post(f'/railstations/{arrival.railwaystation_id}/arrival', json={
+                'locomotive_id': arrival.locomotive_id,
+                'notify_url': notify_url,
+            })
+        except httpx.HTTPError as e:
+            logging.error(f'Arrival of locomotive {arrival.locomotive_id} failed. {str(e)}')
+            return
+        arrival.status_code = response.status_code
+        if response.status_code == status.HTTP_202_ACCEPTED:
+            arrival.estimated_duration = response.json()['estimated_duration']
+
+    requests = []
+    for locomotive_id, delay in zip(locomotive_ids, interarrival_times(model, rate)):
+        await asyncio.sleep(delay)
+        arrival = Arrival(locomotive_id, random.choice(station_ids), time.monotonic())
+        arrivals[locomotive_id] = arrival
+        requests.append(asyncio.create_task(arrive(arrival)))
+    await asyncio.gather(*requests)
+
+
+def report(arrivals: list[Arrival], started_at: float):
+    accepted = [a for a in arrivals if a.status_code == status.HTTP_202_ACCEPTED]
+    completed = [a for a in accepted if a.notified_at is not None]
+    succeeded = [a for a in completed if a.status == ArrivalDepartureStatus.SUCCESS.value]
+    latencies = [a.latency for a in completed]
+    lags = [a.lag for a in completed]
+    elapsed = max([a.notified_at for a in completed], default=time.monotonic()) - started_at
+
+    print(f'Submitted:  {len(arrivals)}')
+    print(f'Accepted:   {len(accepted)}')
+    print(f'Rejected:   {len(arrivals) - len(accepted)}')
+    print(f'Completed:  {len(completed)} ({len(succeeded)} succeeded, {len(completed) - len(succeeded)} failed)')
+    print(f'Lost:       {len(accepted) - len(completed)}')
+    print(f'Throughput: {len(completed) / elapsed:.2f} arrivals/s over {elapsed:.1f}s')
+    for name, values in (('Completion latency', latencies), ('Notification lag', lags)):
+        print(
+            f'{name} [s]: p50={percentile(values, 50):.3f} p95={percentile(values, 95):.3f} '
+            f'p99={percentile(values, 99):.3f} max={max(values, default=float("nan")):.3f}'
+        )
+
+
+async def simulate(args: argparse.Namespace):
+    prefix = f'sim-{uuid4().hex[:8]}'
+    arrival_duration = args.arrival_duration / args.time_compression
+    arrivals: dict[int, Arrival] = {}
+
+    sink = NotifySink(arrivals)
+    sink.expected = args.locomotives
+    server = uvicorn.Server(uvicorn.Config(sink.app, host='0.0.0.0', port=args.sink_port, log_level='warning'))
+    server_task = asyncio.create_task(server.serve())
+    notify_url = f'http://{args.sink_host}:{args.sink_port}/notify'
+
+    limits = httpx.Limits(max_connections=args.max_connections)
+    async with httpx.AsyncClient(base_url=args.api_url, limits=limits, timeout=30) as client:
+        logging.info(f'Creating {args.stations} stations and {args.locomotives} locomotives ({prefix})')
+        station_ids = await create_stations(client, args.stations, arrival_duration, prefix)
+        locomotive_ids = await create_locomotives(args.locomotives, prefix)
+
+        logging.info(
+            f'Driving arrivals at {args.rate}/s ({args.model}), '
+            f'arrival takes {arrival_duration:.3f}s (x{args.time_compression} compression)'
+        )
+        started_at = time.monotonic()
+        await drive_arrivals(client, arrivals, station_ids, locomotive_ids, args.model, args.rate, notify_url)
+
+    sink.expected = sum(a.status_code == status.HTTP_202_ACCEPTED for a in arrivals.values())
+    if sink.received >= sink.expected:
+        sink.done.set()
+    try:
+        await asyncio.wait_for(sink.done.wait(), timeout=arrival_duration + args.timeout)
+    except asyncio.TimeoutError:
+        logging.warning(f'Timed out waiting for notifications, received {sink.received}/{sink.expected}')
+
+    server.should_exit = True
+    await server_task
+
+    report(list(arrivals.values()), started_at)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Runs simulated fleet traffic through the whole arrival pipeline.')
+    parser.add_argument('--stations', type=int, default=10)
+    parser.add_argument('--locomotives', type=int, default=100, help='each locomotive arrives once')
+    parser.add_argument('--rate', type=float, default=10, help='arrival requests per second')
+    parser.add_argument('--model', choices=['poisson', 'constant'], default='poisson')
+    parser.add_argument('--arrival-duration', type=float, default=600, help='real arrival duration in seconds')
+    parser.add_argument('--time-compression', type=float, default=60, help='arrival_duration is divided by it')
+    parser.add_argument('--api-url', default='http://localhost:8000')
+    parser.add_argument('--sink-host', default='web', help='host under which celery workers reach the sink')
+    parser.add_argument('--sink-port', type=int, default=8001)
+    parser.add_argument('--max-connections', type=int, default=100)
+    parser.add_argument('--timeout', type=float, default=60, help='grace time for notifications after last arrival')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    asyncio.run(simulate(parse_args()))
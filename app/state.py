@@ -1,17 +1,111 @@
+import asyncio
 import contextlib
 import logging
+import threading
+import time
+import weakref
 from functools import wraps
+from typing import Optional
 
 import redis.asyncio as redis
 from redis import RedisError
 
-from app.settings import REDIS_URL
+from app.settings import REDIS_URL, REDIS_SOCKET_TIMEOUT, REDIS_CONNECT_TIMEOUT, REDIS_FAILURE_THRESHOLD, \
+    REDIS_RESET_TIMEOUT, INIT_LOCK_TIMEOUT, REDIS_PREWARM_CONNECTIONS
 
 STANDBY = 'STANDBY'
 BUSY = 'BUSY'
 
-pool = redis.ConnectionPool.from_url(REDIS_URL)
-redis_client = redis.Redis.from_pool(pool)
+# redis.asyncio connections are bound to the event loop which created them, and celery threads run a loop per task
+_redis_clients: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, redis.Redis] = weakref.WeakKeyDictionary()
+_redis_clients_lock = threading.Lock()
+
+
+def get_redis_client() -> redis.Redis:
+    """Redis client of the running event loop."""
+    loop = asyncio.get_running_loop()
+    with _redis_clients_lock:
+        client = _redis_clients.get(loop)
+        if client is None:
+            client = _redis_clients[loop] = redis.Redis.from_url(
+                REDIS_URL, socket_timeout=REDIS_SOCKET_TIMEOUT, socket_connect_timeout=REDIS_CONNECT_TIMEOUT
+            )
+    return client
+
+
+async def close_redis_client():
+    with _redis_clients_lock:
+        client = _redis_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+class CircuitOpenError(RedisError):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Fails redis calls fast after failure_threshold consecutive errors.
+    After reset_timeout one probe call is let through (half open), its result closes or opens the circuit again.
+    """
+
+    def __init__(self, failure_threshold: int = REDIS_FAILURE_THRESHOLD, reset_timeout: float = REDIS_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+        self._lock = threading.Lock()  # shared by all threads of the process
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    async def call(self, async_func, *args, **kwargs):
+        probe = self._admit()
+        try:
+            result = await async_func(*args, **kwargs)
+        except RedisError:
+            self.record_failure()
+            raise
+        finally:
+            if probe:
+                self.probing = False
+        self.record_success()
+        return result
+
+    def _admit(self) -> bool:
+        """Returns whether the call is the half open probe, raises if the circuit is open."""
+        with self._lock:
+            if not self.is_open:
+                return False
+            if self.probing or time.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError('Redis circuit is open')
+            self.probing = True
+            return True
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.is_open or self.failures >= self.failure_threshold:
+                if not self.is_open:
+                    logging.error(f'Redis circuit opened after {self.failures} failures')
+                self.opened_at = time.monotonic()
+
+    def record_success(self):
+        with self._lock:
+            if self.is_open:
+                logging.info('Redis circuit closed')
+            self.failures = 0
+            self.opened_at = None
+
+
+breaker = CircuitBreaker()
+
+# request_counter changes which could not be applied to redis yet
+pending_request_counter = 0
+_counters_lock = threading.Lock()
 
 
 def error_wrapper(async_func):
@@ -19,6 +113,8 @@ def error_wrapper(async_func):
     async def wrapper(*args, **kwargs):
         try:
             return await async_func(*args, **kwargs)
+        except CircuitOpenError:
+            pass
         except RedisError as e:
             logging.error(f'Could not perform redis operation. {str(e)}')
     return wrapper
@@ -26,29 +122,69 @@ def error_wrapper(async_func):
 
 @error_wrapper
 async def init_app_state():
-    result = await redis_client.set("request_counter", 0)
+    global pending_request_counter
+    redis_client = get_redis_client()
+    result = await breaker.call(redis_client.set, "request_counter", 0)
+    with _counters_lock:
+        pending_request_counter = 0
     return result
 
 
-@error_wrapper
-@error_wrapper
 async def get_app_state():
-    request_counter = await redis_client.get("request_counter")
-    if int(request_counter):
+    """Raises RedisError when redis is unavailable, the state of the other processes is unknown then."""
+    request_counter = await breaker.call(get_redis_client().get, "request_counter")
+    if int(request_counter or 0):
         return BUSY
     return STANDBY
 
 
 @error_wrapper
+async def change_app_state(delta: int):
+    """
+    Applies delta together with all pending changes, which were not sent because redis was unavailable.
+    The connection is made before INCRBY is sent, so a failed connect is told apart from a lost reply.
+    When the reply is lost the change may have been applied, so it is dropped rather than applied twice.
+    """
+    global pending_request_counter
+    with _counters_lock:
+        delta, pending_request_counter = pending_request_counter + delta, 0
+    redis_client = get_redis_client().client()  # single connection client
+    try:
+        try:
+            await breaker.call(redis_client.initialize)
+        except RedisError:
+            with _counters_lock:
+                pending_request_counter += delta
+            raise
+        try:
+            return await breaker.call(redis_client.incrby, "request_counter", delta)
+        except RedisError as e:
+            logging.error(f'Request counter change of {delta} dropped, it is not known if redis applied it. {str(e)}')
+    finally:
+        await redis_client.aclose()
+
+
 async def incr_app_state():
-    result = await redis_client.incr("request_counter")
-    return result
+    return await change_app_state(1)
 
 
-@error_wrapper
 async def decr_app_state():
-    result = await redis_client.decr("request_counter")
-    return result
+    return await change_app_state(-1)
+
+
+@error_wrapper
+async def change_arrivals_in_flight(station_id: int, delta: int):
+    return await breaker.call(get_redis_client().hincrby, "arrivals_in_flight", str(station_id), delta)
+
+
+@error_wrapper
+async def get_arrivals_in_flight() -> Optional[dict[int, int]]:
+    """
+    Arrivals in flight are not reset with the rest of the state, tasks of the previous run may still decrement them.
+    Counts are clamped at 0, as a decrement can still come without its increment. None while redis is unavailable.
+    """
+    arrivals = await breaker.call(get_redis_client().hgetall, "arrivals_in_flight")
+    return {int(station_id): max(int(count), 0) for station_id, count in arrivals.items()}
 
 
 @contextlib.asynccontextmanager
@@ -58,3 +194,34 @@ async def set_app_busy():
         yield
     finally:
         await decr_app_state()
+
+
+async def init_once(init_id: Optional[str], async_func) -> bool:
+    """
+    Runs async_func only in the first of the workers sharing init_id, the others wait for it to finish.
+    Without init_id (single process) async_func is just run.
+    Returns False if it is not known whether the application is initialized, because redis is unavailable
+    or the lock was not acquired in time, as another worker is still initializing.
+    """
+    if init_id is None:
+        await async_func()
+        return True
+
+    redis_client = get_redis_client()
+    try:
+        async with redis_client.lock("app_init_lock", timeout=INIT_LOCK_TIMEOUT, blocking_timeout=INIT_LOCK_TIMEOUT):
+            if await redis_client.get("app_init_id") == init_id.encode():
+                logging.info(f'Application already initialized ({init_id})')
+                return True
+            await async_func()
+            await redis_client.set("app_init_id", init_id)
+            return True
+    except RedisError as e:  # LockError as well
+        logging.error(f'Could not initialize application ({init_id}). {str(e)}')
+        return False
+
+
+async def prewarm_redis_pool():
+    redis_client = get_redis_client()
+    await asyncio.gather(*(redis_client.ping() for _ in range(REDIS_PREWARM_CONNECTIONS)))
+    logging.info(f'Redis pool warmed up with {REDIS_PREWARM_CONNECTIONS} connections')
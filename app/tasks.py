@@ -6,10 +6,12 @@ from typing import Callable, Optional
 import httpx
 from celery import Celery
 
+from app.batching import arrival_batcher
+from app.board import publish_station_event
 from app.db import get_session_ctx
 from app.models import RailWayStation, Locomotive, ArrivalDepartureStatus
 from app.settings import CELERY_BROKER_URL, CELERY_RESULT_BACKEND
-from app.state import set_app_busy
+from app.state import set_app_busy, change_arrivals_in_flight, close_redis_client
 
 celery = Celery(
     'tasks',
@@ -19,9 +21,15 @@ celery = Celery(
 
 
 def run_async(async_func: Callable) -> Callable:
+    async def run_and_close(*args, **kwargs):
+        try:
+            await async_func(*args, **kwargs)
+        finally:
+            await close_redis_client()  # it belongs to the loop, which is closed after the task
+
     @wraps(async_func)
     def sync_func(*args, **kwargs):
-        asyncio.run(async_func(*args, **kwargs))
+        asyncio.run(run_and_close(*args, **kwargs))
     return sync_func
 
 
@@ -32,15 +40,17 @@ async def _perform_arrival(station_id: int, locomotive_id: int) -> None:
 
     await asyncio.sleep(station.arrival_duration)
 
-    async with get_session_ctx() as session:
-        locomotive.railwaystation = station
-        session.add(locomotive)
-        await session.commit()
+    await arrival_batcher.submit(station.id, locomotive.id)
+
+    locomotive.railwaystation_id = station.id
+    await publish_station_event(station.id, 'arrival', locomotive=locomotive.model_dump(related=False))
 
 
 @celery.task
 @run_async
-async def perform_arrival(station_id: int, locomotive_id: int, notify_url: Optional[str] = None) -> None:
+async def perform_arrival(
+        station_id: int, locomotive_id: int, notify_url: Optional[str] = None, in_flight_counted: bool = True,
+) -> None:
     status = ArrivalDepartureStatus.SUCCESS.value
 
     async with set_app_busy():
@@ -49,6 +59,9 @@ async def perform_arrival(station_id: int, locomotive_id: int, notify_url: Optio
         except Exception as e:  # noqa
             logging.error('Error occurred while performing arrival', exc_info=e)
             status = ArrivalDepartureStatus.FAILURE.value
+        finally:
+            if in_flight_counted:
+                await change_arrivals_in_flight(station_id, -1)
 
     if notify_url:
         async with httpx.AsyncClient() as client:
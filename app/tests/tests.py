@@ -1,12 +1,20 @@
 import asyncio
+import contextlib
 import json
 import logging
+import time
 from typing import Union
 from uuid import uuid4, UUID
 
 import pytest
+from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError, RedisError
+from sqlalchemy.exc import NoResultFound
 from starlette import status
 
+from app import profiling, admission, state, main
+from app.batching import ArrivalBatcher
+from app.main import readiness
+from app.board import StationBoardHub, RESYNC, board_hub
 from app.models import RailWayStation, Locomotive, ArrivalDepartureStatus
 from app.tests.conftest import client
 
@@ -226,8 +234,390 @@ async def test_perform_arrival(
     assert response.json()['detail'] == f'Locomotive {locomotive.name} has been already on station {station.name}'
 
 
+def test_statement_shape():
+    assert profiling.statement_shape(
+        'SELECT locomotive.id FROM locomotive\nWHERE locomotive.id IN ($1::INTEGER, $2::INTEGER) LIMIT 10'
+    ) == profiling.statement_shape(
+        'SELECT locomotive.id FROM locomotive WHERE locomotive.id IN ($1::INTEGER) LIMIT 20'
+    )
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_profile_request(
+    client, db_cleanup, test_data: list[list[Union[RailWayStation, Locomotive]]], monkeypatch
+):
+    monkeypatch.setattr(profiling, 'PROFILE_SECRET', 'secret')
+
+    response = client.get("/railstations")
+    assert 'X-Profile-Id' not in response.headers
+
+    response = client.get(
+        "/railstations", headers={profiling.PROFILE_HEADER: profiling.sign_profile_request('GET', '/railstations')}
+    )
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers['X-Profile-Id']
+    assert int(response.headers['X-Profile-SQL-Count']) == 2  # stations + selectinload of locomotives
+    assert response.headers['X-Profile-N-Plus-One'] == '0'
+
+    response = client.get("/railstations", headers={profiling.PROFILE_HEADER: 'invalid'})
+    assert 'X-Profile-Id' not in response.headers
+
+    expired = profiling.sign_profile_request(
+        'GET', '/railstations', int(time.time() - profiling.PROFILE_SIGNATURE_TTL - 1)
+    )
+    response = client.get("/railstations", headers={profiling.PROFILE_HEADER: expired})
+    assert 'X-Profile-Id' not in response.headers
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_profile_sampled_request(
+    client, db_cleanup, test_data: list[list[Union[RailWayStation, Locomotive]]], monkeypatch, tmp_path
+):
+    monkeypatch.setattr(profiling, 'PROFILE_SAMPLE_RATE', 1)
+    monkeypatch.setattr(profiling, 'PROFILE_DIR', str(tmp_path))
+
+    response = client.get("/railstations/export")
+
+    assert response.status_code == status.HTTP_200_OK
+    assert 'X-Profile-Id' not in response.headers  # timings are not shown to unauthenticated clients
+    [summary] = tmp_path.glob('*.json')
+    assert json.loads(summary.read_text())['sql_count'] >= 1  # queries run while the body was streamed
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_admission_control(
+    client, db_cleanup, test_data: list[list[Union[RailWayStation, Locomotive]]], monkeypatch
+):
+    stations, locomotives = test_data
+    station, locomotive = stations[-1], locomotives[-1]
 
+    monkeypatch.setattr(admission, '_queue_length', (None, float('-inf')))
+    monkeypatch.setattr(admission, 'ARRIVAL_QUEUE_THRESHOLD', -1)
+    response = client.post(
+        f"/railstations/{station.id}/arrival", json={'locomotive_id': locomotive.id, 'notify_url': None}
+    )
+    assert response.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+    assert response.headers['Retry-After'] == str(admission.RETRY_AFTER)
+    assert response.json()['detail'].startswith('Arrival queue is full')
+
+    monkeypatch.setattr(admission, 'MAX_IN_FLIGHT', 0)
+    response = client.get("/railstations")
+    assert response.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+    assert response.json()['detail'] == 'Server is overloaded.'
+    assert admission.in_flight == 0
+
+    monkeypatch.setattr(admission, 'MAX_IN_FLIGHT', 200)
+    for i in range(3):
+        response = client.get(f"/no-such-path-{i}")
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+    response = client.get("/railstations/export")
+    assert response.status_code == status.HTTP_200_OK
+    assert admission.in_flight == 0
+    assert not admission.route_in_flight
+
+    monkeypatch.setitem(admission.ROUTE_CONCURRENCY_LIMITS, '/railstations/export', 0)
+    response = client.get("/railstations/export")
+    assert response.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+    assert response.json()['detail'] == 'Too many concurrent requests to /railstations/export.'
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_arrival_batcher(
+    client, db_cleanup, test_data: list[list[Union[RailWayStation, Locomotive]]]
+):
+    stations, locomotives = test_data
+    station, locomotive = stations[-1], locomotives[-1]
+    batcher = ArrivalBatcher(max_size=10, window=0.1)
+
+    results = await asyncio.gather(
+        batcher.submit(station.id, locomotive.id),
+        batcher.submit(station.id, 1000),
+        return_exceptions=True,
+    )
+
+    assert results[0] is None
+    assert isinstance(results[1], NoResultFound)
 
+    # cancelled waiter must not break the batcher for the following arrivals
+    cancelled = asyncio.create_task(batcher.submit(station.id, locomotives[0].id))
+    await asyncio.sleep(0)
+    cancelled.cancel()
+    await asyncio.wait_for(batcher.submit(station.id, locomotive.id), timeout=5)
 
+    response = client.get(f"/railstations/{station.id}")
+    assert [_['name'] for _ in response.json()['locomotives']] == [locomotive.name]
 
 
+@pytest.mark.asyncio(scope="session")
+async def test_export_railstations(
+    client, db_cleanup, test_data: list[list[Union[RailWayStation, Locomotive]]]
+):
+    response = client.get("/railstations/export")
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers['content-type'] == 'application/x-ndjson'
+
+    stations = [json.loads(line) for line in response.text.splitlines()]
+    assert [station['name'] for station in stations] == ['Station 0', 'Station 1', 'Station 2']
+    assert [[_['name'] for _ in station['locomotives']] for station in stations] == [
+        ['Locomotive 0', 'Locomotive 1'], [], []
+    ]
+
+    response = client.get("/railstations/export", params={'format': 'csv'})
+    assert response.status_code == status.HTTP_200_OK
+
+    header, *rows = response.text.splitlines()
+    assert header.startswith('station_id,station_name')
+    assert [row.split(',')[1] for row in rows] == ['Station 0', 'Station 0', 'Station 1', 'Station 2']
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_railstation_board(
+    client, db_cleanup, test_data: list[list[Union[RailWayStation, Locomotive]]]
+):
+    stations, locomotives = test_data
+
+    with client.websocket_connect(f"/railstations/{stations[0].id}/board") as websocket:
+        data = websocket.receive_json()
+
+    assert data['event'] == 'snapshot'
+    assert data['railwaystation']['name'] == stations[0].name
+    assert [_['name'] for _ in data['railwaystation']['locomotives']] == ['Locomotive 0', 'Locomotive 1']
+
+    await asyncio.sleep(0.1)
+    assert stations[0].id not in board_hub.subscribers  # unsubscribed on disconnect, without any event
+
+
+def test_station_board_hub_slow_consumer():
+    hub = StationBoardHub(client=None, queue_size=2)
+    fast, slow = asyncio.Queue(maxsize=2), asyncio.Queue(maxsize=2)
+    hub.subscribers[1] = {fast, slow}
+
+    hub.dispatch(1, 'first')
+    hub.dispatch(1, 'second')
+    assert [fast.get_nowait(), fast.get_nowait()] == ['first', 'second']
+    hub.dispatch(1, 'third')
+
+    assert fast.get_nowait() == 'third'
+    assert slow.qsize() == 1
+    assert slow.get_nowait() is RESYNC
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_station_board_hub_shared_snapshot():
+    hub = StationBoardHub(client=None)
+    hub.subscribers[1] = {asyncio.Queue(), asyncio.Queue()}
+    loads = []
+
+    async def load(station_id):
+        loads.append(station_id)
+        number = len(loads)
+        await asyncio.sleep(0.01)
+        return f'snapshot {number}'
+
+    hub.resync_all()
+    assert await asyncio.gather(hub.snapshot(1, load), hub.snapshot(1, load)) == ['snapshot 1', 'snapshot 1']
+
+    # load started before RESYNC could miss the dropped events, so it is not shared
+    first = asyncio.create_task(hub.snapshot(1, load))
+    await asyncio.sleep(0)
+    hub.resync_all()
+    assert await asyncio.gather(first, hub.snapshot(1, load)) == ['snapshot 2', 'snapshot 3']
+
+
+class FlakyRedis:
+    """Local stand-in for redis, which can be made slow or failing."""
+
+    def __init__(self):
+        self.data = {}
+        self.fail = False
+        self.timeout = False  # replies are lost, commands are still applied
+        self.latency = 0
+        self.calls = 0
+
+    async def _call(self):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        if self.fail:
+            raise RedisConnectionError('Redis is down')
+
+    def client(self):
+        return self
+
+    async def initialize(self):
+        await self._call()
+        return self
+
+    async def aclose(self):
+        pass
+
+    @contextlib.asynccontextmanager
+    async def lock(self, name, **kwargs):
+        await self._call()
+        yield
+
+    async def set(self, key, value):
+        await self._call()
+        self.data[key] = value.encode() if isinstance(value, str) else value  # redis returns bytes
+        return True
+
+    async def get(self, key):
+        await self._call()
+        return self.data.get(key)
+
+    async def delete(self, key):
+        await self._call()
+        return int(self.data.pop(key, None) is not None)
+
+    async def incrby(self, key, amount):
+        await self._call()
+        self.data[key] = int(self.data.get(key, 0)) + amount
+        if self.timeout:
+            raise RedisTimeoutError('Timeout reading from socket')
+        return self.data[key]
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_redis_circuit_breaker(monkeypatch):
+    fake = FlakyRedis()
+    monkeypatch.setattr(state, 'get_redis_client', lambda: fake)
+    monkeypatch.setattr(state, 'breaker', state.CircuitBreaker(failure_threshold=2, reset_timeout=0.2))
+    monkeypatch.setattr(state, 'pending_request_counter', 0)
+
+    await state.init_app_state()
+    await state.incr_app_state()
+    assert fake.data['request_counter'] == 1
+
+    fake.fail, fake.latency = True, 0.1
+    await state.incr_app_state()
+    await state.incr_app_state()
+    assert state.breaker.is_open
+
+    calls, started_at = fake.calls, time.monotonic()
+    await state.decr_app_state()
+    with pytest.raises(RedisError):
+        await state.get_app_state()  # unknown, not reported as STANDBY
+    assert fake.calls == calls
+    assert time.monotonic() - started_at < fake.latency
+
+    fake.fail, fake.latency = False, 0
+    await asyncio.sleep(0.2)
+    await state.decr_app_state()  # half open probe, applies changes made while redis was down
+
+    assert not state.breaker.is_open
+    assert state.pending_request_counter == 0
+    assert fake.data['request_counter'] == 1
+    assert await state.get_app_state() == state.BUSY
+
+    fake.timeout = True
+    await state.decr_app_state()  # applied, but the reply is lost, so it must not be sent again
+    fake.timeout = False
+    await state.incr_app_state()
+    assert state.pending_request_counter == 0
+    assert fake.data['request_counter'] == 1
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_railstations_occupancy(
+    client, db_cleanup, test_data: list[list[Union[RailWayStation, Locomotive]]]
+):
+    response = client.get("/railstations/occupancy")
+    assert response.status_code == status.HTTP_200_OK
+
+    occupancy = response.json()
+    assert [station['name'] for station in occupancy] == ['Station 0', 'Station 1', 'Station 2']
+    assert [station['total'] for station in occupancy] == [2, 0, 0]
+    assert occupancy[0]['locomotives'] == {'fuel': 2, 'electric': 0, 'steam': 0}
+    assert occupancy[1]['locomotives'] == {'fuel': 0, 'electric': 0, 'steam': 0}
+    assert [station['arrivals_in_flight'] for station in occupancy] == [0, 0, 0]
+
+    stations, _ = test_data
+    await state.change_arrivals_in_flight(stations[1].id, 2)
+    await state.change_arrivals_in_flight(stations[2].id, -1)  # decrement without increment
+    try:
+        response = client.get("/railstations/occupancy")
+        assert [station['arrivals_in_flight'] for station in response.json()] == [0, 2, 0]
+    finally:
+        await state.change_arrivals_in_flight(stations[1].id, -2)
+        await state.change_arrivals_in_flight(stations[2].id, 1)
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_railstations_occupancy_redis_unavailable(
+    client, db_cleanup, test_data: list[list[Union[RailWayStation, Locomotive]]], monkeypatch
+):
+    breaker = state.CircuitBreaker(reset_timeout=60)
+    breaker.opened_at = time.monotonic()
+    monkeypatch.setattr(state, 'breaker', breaker)
+
+    response = client.get("/railstations/occupancy")
+    assert response.status_code == status.HTTP_200_OK
+
+    occupancy = response.json()
+    assert [station['total'] for station in occupancy] == [2, 0, 0]
+    assert [station['arrivals_in_flight'] for station in occupancy] == [None, None, None]  # unknown, not 0
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_ready(client):
+    response = client.get("/ready")
+
+    assert response.status_code == status.HTTP_200_OK
+    data = response.json()
+    assert data['ready'] is True
+    assert data['initialized'] and data['db_pool'] and data['redis_pool']
+
+
+def test_redis_client_per_event_loop():
+    async def get_clients():
+        client = state.get_redis_client()
+        assert state.get_redis_client() is client
+        await state.close_redis_client()
+        return client
+
+    assert asyncio.run(get_clients()) is not asyncio.run(get_clients())
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_init_once(monkeypatch, mocker):
+    fake = FlakyRedis()
+    monkeypatch.setattr(state, 'get_redis_client', lambda: fake)
+    init = mocker.AsyncMock()
+
+    fake.fail = True
+    assert await state.init_once('init-id', init) is False
+    init.assert_not_called()
+
+    fake.fail = False
+    assert await state.init_once('init-id', init) is True
+    assert await state.init_once('init-id', init) is True  # another worker of the same start
+    init.assert_called_once()
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_not_ready(client, monkeypatch):
+    monkeypatch.setitem(readiness, 'initialized', False)
+
+    response = client.get("/ready")
+
+    assert response.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+    assert response.json()['ready'] is False
+    assert response.json()['initialized'] is False
+
+    response = client.get("/railstations")
+    assert response.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+
+
+@pytest.mark.asyncio(scope="session")
+async def test_prepare_worker(monkeypatch, mocker):
+    monkeypatch.setitem(readiness, 'initialized', False)
+    monkeypatch.setitem(readiness, 'db_pool', False)
+    prewarm_db_pool = mocker.AsyncMock()
+    monkeypatch.setattr(main, 'prewarm_db_pool', prewarm_db_pool)
+    monkeypatch.setattr(main, 'init_once', mocker.AsyncMock(side_effect=OSError('Connection refused')))
+
+    assert await main.prepare_worker() is False  # database errors do not stop the retries
+    assert readiness['db_pool'] and not readiness['initialized']
+
+    monkeypatch.setattr(main, 'init_once', mocker.AsyncMock(return_value=True))
+    assert await main.prepare_worker() is True
+    prewarm_db_pool.assert_awaited_once()  # warmed up pools are not warmed up again